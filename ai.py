@@ -1,18 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import StrEnum, auto
+from functools import lru_cache
 from google import genai
 from google.genai import types, errors
-import json
-from pydantic import BaseModel, model_validator
-import time
-from typing import List, Optional
-import yaml
+import orjson
+from pydantic import BaseModel, ConfigDict, ValidationError, model_validator
+import threading
+from typing import Any, Dict, List, Optional, TypeVar
+from cache import EmbeddingCache, ResponseCache
 from io_util import add_to_revisit_list
 from notification import send_push_notification
+from rate_limit import rate_limit_cooldown, wait_for_rate_limit
 from sheet import ProviderItem
 from type import Provider, SheetName
 
 class MatchingItem(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     provider: Provider  
     id: int
     code: str
@@ -24,6 +29,8 @@ class AIMatchType(StrEnum):
     NoMatch = auto()
 
 class AIResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     type: AIMatchType
     item: Optional[MatchingItem] = None
     reasoning: str
@@ -36,88 +43,119 @@ class AIResponse(BaseModel):
             raise ValueError("When match type is NoMatch, item should be None")
         return self
 
+class AIBatchMatch(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    query_id: int
+    response: AIResponse
+
+class AIBatchResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    matches: List[AIBatchMatch]
+
+class AIRawBatchResponse(BaseModel):
+    # Same shape as AIBatchResponse, but matches are left unvalidated so each can be checked on its own
+    model_config = ConfigDict(frozen=True)
+
+    matches: List[Dict[str, Any]]
+
+EMBEDDING_MODEL = "text-embedding-004"
+ADVANCED_MATCH_MODEL = "gemini-2.5-flash"
 MAX_EMBED_CHUNK_SIZE = 100  # Max embeddings per request
+FALLBACK_NO_MATCH_REASONING = "Fallback NoMatch"
 
 @dataclass
 class ItemEmbedResult:
     item: ProviderItem
     embedding: list[float]
 
-def get_embedding_content(item: ProviderItem) -> str:
-    if item.sheet_name == SheetName.Equipment:
-        return f"""
-Category: {item.get('Category.Name') or 'N/A'}
-Name: {item.get('Name')}
-Description: {item.get('Description')}
-Code: {item.code}
-Brand: {item.get('Brand') or 'N/A'}
-Manufacturer: {item.get('Manufacturer') or 'N/A'}
-Model: {item.get('Model') or 'N/A'}
+EMBEDDING_TEMPLATE = """
+Category: {category}
+Name: {name}
+Description: {description}
+Code: {code}
 """
-    
-    return f"""
-Category: {item.get('Category.Name') or 'N/A'}
-Name: {item.get('Name')}
-Description: {item.get('Description')}
-Code: {item.code}
+EQUIPMENT_EMBEDDING_TEMPLATE = EMBEDDING_TEMPLATE + """Brand: {brand}
+Manufacturer: {manufacturer}
+Model: {model}
 """
 
-def items_to_yaml(items: List[ProviderItem]) -> str:
-    yaml_data = []
+@lru_cache(maxsize=None)
+def get_embedding_content(item: ProviderItem) -> str:
+    # Cached per item, since embedding, cache keys and similarity lookups all need the same content
+    if item.sheet_name == SheetName.Equipment:
+        return EQUIPMENT_EMBEDDING_TEMPLATE.format_map({
+            'category': item.category_name or 'N/A',
+            'name': item.name,
+            'description': item.description,
+            'code': item.code,
+            'brand': item.brand or 'N/A',
+            'manufacturer': item.manufacturer or 'N/A',
+            'model': item.model or 'N/A',
+        })
+    
+    return EMBEDDING_TEMPLATE.format_map({
+        'category': item.category_name or 'N/A',
+        'name': item.name,
+        'description': item.description,
+        'code': item.code,
+    })
+
+# (Prompt field name, item attribute) pairs, in prompt order
+ITEM_PROMPT_FIELDS = (
+    ('Category', 'category_name'),
+    ('Name', 'name'),
+    ('Description', 'description'),
+)
+EQUIPMENT_PROMPT_FIELDS = ITEM_PROMPT_FIELDS + (
+    ('Type', 'type'),
+    ('Brand', 'brand'),
+    ('Manufacturer', 'manufacturer'),
+    ('Model', 'model'),
+)
+
+def items_to_jsonl(items: List[ProviderItem]) -> str:
+    lines = []
     
     for item in items:
+        prompt_fields = EQUIPMENT_PROMPT_FIELDS if item.sheet_name == SheetName.Equipment else ITEM_PROMPT_FIELDS
         item_dict = {
             'Provider': item.provider.value,
             'Id': item.id,
             'Code': item.code,
+            **{field: value for field, attribute in prompt_fields if (value := getattr(item, attribute))}
         }
-        
-        if value := item.get('Category.Name'):
-            item_dict['Category'] = value
-        if value := item.get('Name'):
-            item_dict['Name'] = value
-        if value := item.get('Description'):
-            item_dict['Description'] = value
-        
-        if item.sheet_name == SheetName.Equipment:
-            if value := item.get('Type'):
-                item_dict['Type'] = value
-            if value := item.get('Brand'):
-                item_dict['Brand'] = value
-            if value := item.get('Manufacturer'):
-                item_dict['Manufacturer'] = value
-            if value := item.get('Model'):
-                item_dict['Model'] = value
-        
-        yaml_data.append(item_dict)
+        lines.append(orjson.dumps(item_dict))
     
-    return yaml.dump(yaml_data, default_flow_style=False, sort_keys=False)
+    return b"\n".join(lines).decode()
 
 
-def item_to_json(item: ProviderItem) -> str:
-    return json.dumps({
+def query_item_to_dict(item: ProviderItem) -> dict:
+    return {
         'Id': item.id,
         'Code': item.code,
-        'Name': item.get('Name'),
-        'Description': item.get('Description')
-    }, indent=2)
+        'Name': item.name,
+        'Description': item.description
+    }
 
 
-def generate_prompt_messages(reference_items: List[ProviderItem], query_item: ProviderItem) -> List[types.Content]:
-    reference_yaml = items_to_yaml(reference_items)
-    query_json = item_to_json(query_item)
-    
-    return [
-        types.Content(
-            role="user",
-            parts=[
-                types.Part(text=f"""
+def item_to_json(item: ProviderItem) -> str:
+    return orjson.dumps(query_item_to_dict(item), option=orjson.OPT_INDENT_2).decode()
+
+
+TERMINOLOGY_FILE_NAME = "data/terminology.yaml"
+
+with open(TERMINOLOGY_FILE_NAME, "rb") as terminology_file:
+    TERMINOLOGY_BLOB = types.Blob(mime_type="text/plain", data=terminology_file.read())
+
+MATCHING_INSTRUCTIONS_PART = types.Part(text=f"""
 Your goal is to consolidate inventory items into an ongoing master list.
 You will be prompted with a query item, for which you must determine whether it corresponds to an existing entry in the master list, or is a new item that should be added to the master list.
 
 You will be provided with the following resources:
 - TERMINOLOGY KEY: YAML file containing standard terms and their alternative forms
-- MASTER INVENTORY LIST: YAML file containing all master inventory items
+- MASTER INVENTORY LIST: JSON lines file containing all master inventory items (one JSON object per line)
 - QUERY ITEM: JSON object representing the item to be matched
 
 Matching Guidelines:
@@ -156,7 +194,21 @@ Look for the best matching item in the master list, and you must return a JSON o
 
 IMPORTANT: If you return a match, only return an item that actually exist in the provided master list
 """)
-            ]
+
+BATCH_INSTRUCTIONS_PART = types.Part(text="""
+You will be prompted with several query items at once (QUERY ITEMS, one JSON object per line) instead of a single query item.
+Match each query item independently, following the guidelines above.
+Return a JSON object with a "matches" list containing exactly one entry per query item, where "query_id" is the query item's Id and "response" is its match result in one of the formats above.
+""")
+
+
+def generate_reference_prompt_messages(reference_items: List[ProviderItem], instruction_parts: tuple[types.Part, ...] = (MATCHING_INSTRUCTIONS_PART,)) -> List[types.Content]:
+    reference_jsonl = items_to_jsonl(reference_items)
+    
+    return [
+        types.Content(
+            role="user",
+            parts=list(instruction_parts)
         ),
 
         types.Content(
@@ -166,10 +218,7 @@ IMPORTANT: If you return a match, only return an item that actually exist in the
                     text="=== TERMINOLOGY KEY (YAML) ==="
                 ),
                 types.Part(
-                    inline_data=types.Blob(
-                        mime_type="text/plain",
-                        data=open("data/terminology.yaml", "rb").read()
-                    )
+                    inline_data=TERMINOLOGY_BLOB
                 )
             ]
         ),
@@ -178,13 +227,19 @@ IMPORTANT: If you return a match, only return an item that actually exist in the
             role="user",
             parts=[
                 types.Part(
-                    text="=== MASTER INVENTORY LIST (YAML) ==="
+                    text="=== MASTER INVENTORY LIST (JSONL) ==="
                 ),
                 types.Part(
-                    text=reference_yaml
+                    text=reference_jsonl
                 )
             ]
-        ),
+        )
+    ]
+
+
+def generate_prompt_messages(reference_items: List[ProviderItem], query_item: ProviderItem) -> List[types.Content]:
+    return [
+        *generate_reference_prompt_messages(reference_items),
 
         types.Content(
             role="user",
@@ -193,18 +248,75 @@ IMPORTANT: If you return a match, only return an item that actually exist in the
                     text="=== QUERY ITEM (JSON) ==="
                 ),
                 types.Part(
-                    text=query_json
+                    text=item_to_json(query_item)
+                )
+            ]
+        )
+    ]
+
+
+def generate_batch_prompt_messages(reference_items: List[ProviderItem], query_items: List[ProviderItem]) -> List[types.Content]:
+    query_jsonl = b"\n".join(orjson.dumps(query_item_to_dict(item)) for item in query_items).decode()
+    
+    return [
+        *generate_reference_prompt_messages(reference_items, (MATCHING_INSTRUCTIONS_PART, BATCH_INSTRUCTIONS_PART)),
+
+        types.Content(
+            role="user",
+            parts=[
+                types.Part(
+                    text="=== QUERY ITEMS (JSONL) ==="
+                ),
+                types.Part(
+                    text=query_jsonl
                 )
             ]
         )
     ]
 
 
+@lru_cache(maxsize=4)
+def shared_genai_client(api_key: str) -> genai.Client:
+    # One client (and connection pool) per API key, shared by every GeminiClient
+    return genai.Client(api_key=api_key)
+
+
+RESPONSE_SCHEMA = AIResponse # Single schema shared by every match request
+BATCH_RESPONSE_SCHEMA = AIBatchResponse
+
+ResponseModel = TypeVar('ResponseModel', bound=BaseModel)
+
+def prompt_cache_content(prompt_messages: List[types.Content]) -> str:
+    return orjson.dumps([message.model_dump(mode='json', exclude_none=True) for message in prompt_messages]).decode()
+
+def response_cache_model(model: str, response_schema: type[BaseModel]) -> str:
+    # Responses are only reusable for the same model and response schema
+    return f"{model}/{response_schema.__name__}"
+
+@lru_cache(maxsize=None)
+def match_response_config(thinking_budget: Optional[int] = None, response_schema: type[BaseModel] = RESPONSE_SCHEMA) -> types.GenerateContentConfig:
+    # Built once per thinking budget and schema, and shared (read-only) by every request
+    return types.GenerateContentConfig(
+        temperature=0,
+        response_mime_type="application/json",
+        response_schema=response_schema,
+        thinking_config=types.ThinkingConfig(
+            thinking_budget=thinking_budget,
+            include_thoughts=False
+        ) if thinking_budget is not None else None
+    )
+
+
 class GeminiClient:
     CHUNK_SIZE = 4_000
+    MAX_CHUNK_WORKERS = 8 # Max concurrent chunk requests per query item
+    MAX_CONCURRENT_REQUESTS = 8 # Max in-flight chunk requests across all threads, to stay under the RPM quota
 
-    def __init__(self, api_key: str):
-        self.__client = genai.Client(api_key=api_key)
+    def __init__(self, api_key: str, embedding_cache: Optional[EmbeddingCache] = None, response_cache: Optional[ResponseCache] = None):
+        self.__client = shared_genai_client(api_key)
+        self.__request_slots = threading.BoundedSemaphore(self.MAX_CONCURRENT_REQUESTS)
+        self.__embedding_cache = embedding_cache
+        self.__response_cache = response_cache
 
 
     def embed_chunk(self, items: list[ProviderItem], retry_count: int = 0) -> list[ItemEmbedResult]:
@@ -213,42 +325,65 @@ class GeminiClient:
         if len(items) > MAX_EMBED_CHUNK_SIZE:
             raise Exception(f"Chunk size {len(items)} is greater than max chunk size {MAX_EMBED_CHUNK_SIZE}")
         
+        embedding_contents = [get_embedding_content(item) for item in items]
+        embeddings = self.__embedding_cache.get_many(EMBEDDING_MODEL, embedding_contents) if self.__embedding_cache is not None else {}
+
+        # Only request embeddings for content that isn't cached yet
+        missing_items: dict[str, ProviderItem] = {}
+        for item, content in zip(items, embedding_contents):
+            if content not in embeddings:
+                missing_items.setdefault(content, item)
+
         try:
-            embedding_contents = [get_embedding_content(item) for item in items]
-            embed_response = self.__client.models.embed_content(
-                model="text-embedding-004",
-                contents=embedding_contents,
-                config=types.EmbedContentConfig(task_type="semantic_similarity")
-            )
-            
-            if embed_response.embeddings is None:
-                raise Exception(f"No embeddings returned for chunk")
-            
-            results = []
-            for item, embedding in zip(items, embed_response.embeddings):
-                if embedding.values is None:
-                    raise Exception(f"No embedding values returned for item ({item.provider} {item.id})")
-                results.append(ItemEmbedResult(item=item, embedding=embedding.values))
+            if missing_items:
+                rate_limit_cooldown.wait()
+                embed_response = self.__client.models.embed_content(
+                    model=EMBEDDING_MODEL,
+                    contents=list(missing_items.keys()),
+                    config=types.EmbedContentConfig(task_type="semantic_similarity")
+                )
+                
+                if embed_response.embeddings is None:
+                    raise Exception(f"No embeddings returned for chunk")
+                
+                new_embeddings: dict[str, list[float]] = {}
+                for (content, item), embedding in zip(missing_items.items(), embed_response.embeddings):
+                    if embedding.values is None:
+                        raise Exception(f"No embedding values returned for item ({item.provider} {item.id})")
+                    new_embeddings[content] = embedding.values
+
+                if self.__embedding_cache is not None:
+                    self.__embedding_cache.put_many(EMBEDDING_MODEL, new_embeddings)
+                embeddings.update(new_embeddings)
             
-            return results
+            return [
+                ItemEmbedResult(item=item, embedding=embeddings[content])
+                for item, content in zip(items, embedding_contents)
+            ]
             
         except errors.ClientError as e:
             if e.code == 429 and retry_count < MAX_RETRIES:
-                sleep_time = 60 # Gemini request quota is per minute
-                print(f"Rate limit exceeded for chunk, sleeping for {sleep_time}s before retry {retry_count + 1}/{MAX_RETRIES}...")
-                time.sleep(sleep_time)
+                wait_for_rate_limit(e, retry_count, MAX_RETRIES)
                 return self.embed_chunk(items, retry_count + 1)
             else:
                 raise e
         except Exception as e:
             raise e
 
+    def embed_items(self, items: list[ProviderItem]) -> list[ItemEmbedResult]:
+        results = []
+        for i in range(0, len(items), MAX_EMBED_CHUNK_SIZE):
+            results.extend(self.embed_chunk(items[i:i + MAX_EMBED_CHUNK_SIZE]))
+        return results
+
     def generate_match_response_chunked(self, reference_items: List[ProviderItem], query_item: ProviderItem) -> AIResponse:
         if len(reference_items) <= self.CHUNK_SIZE:
-            return [self.generate_match_response(reference_items, query_item)]
+            return self.generate_match_response(reference_items, query_item)
         
         reference_item_chunks = [reference_items[i:i + self.CHUNK_SIZE] for i in range(0, len(reference_items), self.CHUNK_SIZE)]
-        chunk_responses = [self.generate_match_response(chunk, query_item) for chunk in reference_item_chunks]
+        # Chunk requests are independent network calls, so run them concurrently (map preserves chunk order)
+        with ThreadPoolExecutor(max_workers=min(self.MAX_CHUNK_WORKERS, len(reference_item_chunks))) as executor:
+            chunk_responses = list(executor.map(lambda chunk: self.generate_match_response(chunk, query_item), reference_item_chunks))
         matching_chunk_responses = [response for response in chunk_responses if response.type != AIMatchType.NoMatch]
 
         match len(matching_chunk_responses):
@@ -257,97 +392,158 @@ class GeminiClient:
             case 1:
                 return matching_chunk_responses[0] # Single match
             case _:
+                items_by_id = {(item.provider, item.id): item for item in reference_items}
+                items_by_code = {(item.provider, item.code): item for item in reference_items}
                 candidate_items = []
                 for response in matching_chunk_responses:
-                    item_found = False
-                    for item in reference_items:
-                        if item.provider == response.item.provider and (item.id == response.item.id or item.code == response.item.code):
-                            candidate_items.append(item)
-                            item_found = True
-                    if not item_found:
+                    item = items_by_id.get((response.item.provider, response.item.id)) or items_by_code.get((response.item.provider, response.item.code))
+                    if item is None:
                         print(f"WARNING: Item {response.item.provider}: {response.item.id}, {response.item.code} not found in reference items")
+                        continue
+                    candidate_items.append(item)
                 if len(candidate_items) == 0:
                     raise Exception(f"No matching items found in reference items")    
                 return self.generate_match_response(candidate_items, query_item)
 
     def generate_match_response(self, reference_items: List[ProviderItem], query_item: ProviderItem) -> AIResponse:
-        response = self.__client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=generate_prompt_messages(reference_items, query_item),
-                config=types.GenerateContentConfig(
-                    temperature=0,
-                    response_mime_type="application/json",
-                    response_schema=AIResponse
-                )
-            )
-        return AIResponse.model_validate_json(response.text)
+        max_retries = 3
+        for attempt in range(max_retries + 1):
+            try:
+                rate_limit_cooldown.wait()
+                with self.__request_slots:
+                    response = self.__client.models.generate_content(
+                        model="gemini-2.0-flash",
+                        contents=generate_prompt_messages(reference_items, query_item),
+                        config=match_response_config()
+                    )
+                return AIResponse.model_validate_json(response.text)
+
+            except errors.ClientError as e:
+                if e.code == 429 and attempt < max_retries:
+                    wait_for_rate_limit(e, attempt, max_retries)
+                    continue
+                else:
+                    raise e
     
     def generate_match_response_advanced(self, reference_items: List[ProviderItem], query_item: ProviderItem) -> AIResponse:
+        prompt_messages = generate_prompt_messages(reference_items, query_item)
+        response = self.__generate_advanced_response(prompt_messages, RESPONSE_SCHEMA, f"item {query_item.provider}:{query_item.id}")
+        if response is not None:
+            return response
+            
+        add_to_revisit_list(query_item.to_item_ref())
+        return AIResponse(type=AIMatchType.NoMatch, reasoning=FALLBACK_NO_MATCH_REASONING)
+
+    def generate_match_response_batch(self, reference_items: List[ProviderItem], query_items: List[ProviderItem]) -> List[AIResponse]:
+        if len(query_items) == 1:
+            return [self.generate_match_response_advanced(reference_items, query_items[0])]
+
+        prompt_messages = generate_batch_prompt_messages(reference_items, query_items)
+        responses_by_id: dict[int, AIResponse] = {}
+        try:
+            batch_response = self.__generate_advanced_response(
+                prompt_messages,
+                BATCH_RESPONSE_SCHEMA,
+                f"batch of {len(query_items)} items from {query_items[0].provider}",
+                AIRawBatchResponse
+            )
+            if batch_response is not None:
+                # One malformed match shouldn't throw away the valid ones
+                for raw_match in batch_response.matches:
+                    try:
+                        match = AIBatchMatch.model_validate(raw_match)
+                    except ValidationError as e:
+                        print(f"Invalid match in batch response, matching it again: {e}")
+                        continue
+                    responses_by_id[match.query_id] = match.response
+        except ValidationError as e:
+            print(f"Invalid batch response, matching items individually: {e}")
+        
+        # Only the queries the batch response skipped or got wrong are requested again
+        missing_items = [query_item for query_item in query_items if query_item.id not in responses_by_id]
+        if missing_items:
+            if len(missing_items) < len(query_items):
+                missing_responses = self.generate_match_response_batch(reference_items, missing_items)
+            else:
+                # The batch made no progress, so don't retry it as a batch
+                missing_responses = [self.generate_match_response_advanced(reference_items, query_item) for query_item in missing_items]
+            for query_item, response in zip(missing_items, missing_responses):
+                responses_by_id[query_item.id] = response
+        return [responses_by_id[query_item.id] for query_item in query_items]
+
+    def __generate_advanced_response(self, prompt_messages: List[types.Content], response_schema: type[BaseModel], description: str, parse_schema: Optional[type[ResponseModel]] = None) -> Optional[ResponseModel]:
+        # parse_schema lets a caller validate the response more loosely than the schema the model is asked for
+        parse_schema = parse_schema or response_schema
+        # Identical prompts get identical answers (temperature 0), so reuse responses from earlier runs
+        response_cache_prompt = None
+        if self.__response_cache is not None:
+            response_cache_prompt = prompt_cache_content(prompt_messages)
+            cached_response = self.__response_cache.get(response_cache_model(ADVANCED_MATCH_MODEL, response_schema), response_cache_prompt)
+            if cached_response is not None:
+                print(f"Response cache hit for {description}")
+                return parse_schema.model_validate_json(cached_response)
+
         thinking_budget = 18000
         max_retries = 3
         for attempt in range(max_retries + 1):
             try:
-                response = self.__client.models.generate_content(
-                    model="gemini-2.5-flash",
-                    contents=generate_prompt_messages(reference_items, query_item),
-                    config=types.GenerateContentConfig(
-                        temperature=0,
-                        response_mime_type="application/json",
-                        response_schema=AIResponse,
-                        thinking_config=types.ThinkingConfig(
-                            thinking_budget=thinking_budget if attempt < max_retries else 0,
-                            include_thoughts=False
-                        )
+                rate_limit_cooldown.wait()
+                with self.__request_slots:
+                    response = self.__client.models.generate_content(
+                        model=ADVANCED_MATCH_MODEL,
+                        contents=prompt_messages,
+                        config=match_response_config(thinking_budget if attempt < max_retries else 0, response_schema)
                     )
-                )
                 print(f"response.text: {response.text}")          
                 
                 # Sometimes the API randomly returns None, so retry
                 if response.text is None:
-                    send_push_notification("Script Warning", f"API returned None response for item {query_item.provider}:{query_item.id}")
+                    send_push_notification("Script Warning", f"API returned None response for {description}")
                     print(f"response: {response}")
                     if attempt < max_retries:
                         thinking_budget -= 3000
-                        print(f"API returned None response for item {query_item.provider}:{query_item.id}, retrying...")
+                        print(f"API returned None response for {description}, retrying...")
                         continue
                     else:
-                        raise Exception(f"API returned None response after {max_retries + 1} attempts for item {query_item.provider}:{query_item.id}")
+                        raise Exception(f"API returned None response after {max_retries + 1} attempts for {description}")
                 
-                return AIResponse.model_validate_json(response.text)
+                parsed_response = parse_schema.model_validate_json(response.text)
+                if response_cache_prompt is not None:
+                    self.__response_cache.put(response_cache_model(ADVANCED_MATCH_MODEL, response_schema), response_cache_prompt, response.text)
+                return parsed_response
 
             except errors.ClientError as e:
                 if e.code == 429 and attempt < max_retries:
-                    retry_delay = 30 # Default fallback
-                    print(f"Rate limited (429). Retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries + 1})")
-                    time.sleep(retry_delay)
+                    wait_for_rate_limit(e, attempt, max_retries)
                     continue
                 else:
                     raise e
             except Exception as e:
                 raise e
-            
-        add_to_revisit_list(query_item.to_item_ref())
-        return AIResponse(type=AIMatchType.NoMatch, reasoning="Fallback NoMatch")
+        return None
 
     def generate_followup_match_response(self, reference_items: List[ProviderItem], query_item: ProviderItem, previous_response: AIResponse) -> AIResponse:
         max_retries = 3
+        prompt_messages = generate_prompt_messages(reference_items, query_item)
         for attempt in range(max_retries + 1):
             try:
-                response = self.__client.models.generate_content(
-                    model="gemini-2.5-flash",
-                    contents=[
-                        *generate_prompt_messages(reference_items, query_item),
-                        types.Content(
-                            role="model",
-                            parts=[
-                                types.Part(text="=== Previous Response ==="),
-                                types.Part(text=previous_response.model_dump_json(indent=2))
-                            ]
-                        ),
-                        types.Content(
-                            role="user",
-                            parts=[
-                                types.Part(text=f"""
+                rate_limit_cooldown.wait()
+                with self.__request_slots:
+                    response = self.__client.models.generate_content(
+                        model=ADVANCED_MATCH_MODEL,
+                        contents=[
+                            *prompt_messages,
+                            types.Content(
+                                role="model",
+                                parts=[
+                                    types.Part(text="=== Previous Response ==="),
+                                    types.Part(text=previous_response.model_dump_json())
+                                ]
+                            ),
+                            types.Content(
+                                role="user",
+                                parts=[
+                                    types.Part(text=f"""
 CRITICAL: The previous match suggestion failed because the suggested item (Provider: {previous_response.item.provider}, ID: {previous_response.item.id}, Code: {previous_response.item.code}) does not exist in the master list.
 
 This means either:
@@ -358,40 +554,18 @@ Please re-evaluate the query item and find another match from the master list. C
 - Check that the provider/ID/code combination all exist for that entry in the master list
 - Return a different match from the master list (or no match otherwise)
 
-The query item you're trying to match is: {item_to_json(query_item)}
+The query item you're trying to match is the QUERY ITEM provided above.
 """)
-                            ]
-                        )
-                    ],
-                    config=types.GenerateContentConfig(
-                        temperature=0,
-                        response_mime_type="application/json",
-                        response_schema=AIResponse,
-                        thinking_config=types.ThinkingConfig(
-                            thinking_budget=15000,
-                            include_thoughts=False
-                        )
+                                ]
+                            )
+                        ],
+                        config=match_response_config(15000)
                     )
-                )
                 return AIResponse.model_validate_json(response.text)
                 
             except errors.ClientError as e:
                 if e.code == 429 and attempt < max_retries:
-                    # TO FIX: Parse retry delay from error
-                    retry_delay = 30 # Default fallback
-                    print(f"e.details: {e.details}")
-                    try:
-                        if 'details' in e.details:
-                            for detail in e.details['details']:
-                                if detail.get('@type') == 'type.googleapis.com/google.rpc.RetryInfo':
-                                    retry_delay_str = detail.get('retryDelay', '30s')
-                                    retry_delay = int(retry_delay_str.rstrip('s'))
-                                    break
-                    except (KeyError, ValueError, TypeError):
-                        retry_delay = 30 
-                    
-                    print(f"Rate limited (429). Retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries + 1})")
-                    time.sleep(retry_delay)
+                    wait_for_rate_limit(e, attempt, max_retries)
                     continue
                 else:
                     # Re-raise non-429 errors or if max retries exceeded
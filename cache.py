@@ -0,0 +1,69 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Optional
+import numpy as np
+
+
+def content_key(model: str, content: str) -> str:
+    return hashlib.blake2b(f"{model}\n{content}".encode(), digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, filename: str):
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self.__connection = sqlite3.connect(filename, check_same_thread=False)
+        self.__lock = threading.Lock()
+        with self.__lock:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+            self.__connection.commit()
+
+    def get_many(self, model: str, contents: list[str]) -> dict[str, list[float]]:
+        key_to_content = {content_key(model, content): content for content in contents}
+        if not key_to_content:
+            return {}
+
+        placeholders = ",".join("?" * len(key_to_content))
+        with self.__lock:
+            rows = self.__connection.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})",
+                list(key_to_content.keys())
+            ).fetchall()
+
+        return {
+            key_to_content[key]: np.frombuffer(embedding, dtype=np.float32).tolist()
+            for key, embedding in rows
+        }
+
+    def put_many(self, model: str, embeddings: dict[str, list[float]]) -> None:
+        rows = [
+            (content_key(model, content), np.asarray(embedding, dtype=np.float32).tobytes())
+            for content, embedding in embeddings.items()
+        ]
+        with self.__lock:
+            self.__connection.executemany("INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)", rows)
+            self.__connection.commit()
+
+
+class ResponseCache:
+    def __init__(self, filename: str):
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self.__connection = sqlite3.connect(filename, check_same_thread=False)
+        self.__lock = threading.Lock()
+        with self.__lock:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+            self.__connection.commit()
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT response FROM responses WHERE key = ?",
+                (content_key(model, prompt),)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, model: str, prompt: str, response: str) -> None:
+        with self.__lock:
+            self.__connection.execute("INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (content_key(model, prompt), response))
+            self.__connection.commit()
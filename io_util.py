@@ -1,100 +1,197 @@
-import json
-from itertools import chain
+from functools import lru_cache
+import orjson
 import os
-from typing import List, Dict, Any, Optional
+import threading
+from typing import BinaryIO, Callable, List, Dict, Any, Iterable, Iterator, Optional
 from type import ItemMerge, ItemOutput, ItemReference, MatchType, ExactCodeMatch, HazyLLMMatch, Provider, StrongLLMMatch, NoMatch
 from openpyxl import Workbook
 
 def file_exists(filename: str) -> bool:
     return os.path.exists(filename)
 
+MERGE_DESERIALIZERS: Dict[MatchType, Callable[[Dict[str, Any]], ItemMerge]] = {
+    MatchType.ExactCode: ExactCodeMatch.from_dict,
+    MatchType.StrongLLM: StrongLLMMatch.from_dict,
+    MatchType.HazyLLM: HazyLLMMatch.from_dict,
+    MatchType.NoMatch: NoMatch.from_dict,
+}
+
 def deserialize_merge(data: Dict[str, Any]) -> ItemMerge:
     merge_type = data.get("type")
     
-    if merge_type == MatchType.ExactCode:
-        return ExactCodeMatch.from_dict(data)
-    elif merge_type == MatchType.StrongLLM:
-        return StrongLLMMatch.from_dict(data)
-    elif merge_type == MatchType.HazyLLM:
-        return HazyLLMMatch.from_dict(data)
-    elif merge_type == MatchType.NoMatch:
-        return NoMatch.from_dict(data)
-    else:
+    deserializer = MERGE_DESERIALIZERS.get(merge_type)
+    if deserializer is None:
         raise ValueError(f"Unknown merge type: {merge_type}")
+    return deserializer(data)
+
+def merges_to_ndjson(merges: List[ItemMerge]) -> bytes:
+    return b"".join(orjson.dumps(merge.to_dict()) + b"\n" for merge in merges)
+
+def save_merges_to_ndjson(merges: List[ItemMerge], filename: str) -> None:
+    write_file_atomic(filename, merges_to_ndjson(merges))
+
+def append_merges_to_ndjson(merges: List[ItemMerge], file: BinaryIO) -> None:
+    # Only new merges are written, so checkpointing cost doesn't grow with the total merge count
+    file.write(merges_to_ndjson(merges))
+    file.flush()
+    os.fsync(file.fileno()) # Durable once this returns, even if the process dies right after
+
+def write_file_atomic(filename: str, data: bytes) -> None:
+    # Write to a temp file and swap it in, so a crash mid-write never leaves a truncated file behind
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, 'wb') as f:
+        f.write(data)
+    os.replace(temp_filename, filename)
 
-def save_merges_to_json(merges: List[ItemMerge], filename: str) -> None:
-    with open(filename, 'w') as f:
-        json.dump([merge.to_dict() for merge in merges], f, indent=2)
+class RevisitLog:
+    def __init__(self, filename: str):
+        self.__filename = filename
+        self.__file = None
+        self.__lock = threading.Lock()
+
+    def write(self, item_ref: ItemReference) -> None:
+        with self.__lock:
+            # Opened on first use and kept open, rather than reopened for every line
+            if self.__file is None:
+                os.makedirs(os.path.dirname(self.__filename), exist_ok=True)
+                self.__file = open(self.__filename, 'a', encoding='utf-8')
+            self.__file.write(f"{item_ref.provider},{item_ref.sheet_name},{item_ref.id}\n")
+            self.__file.flush()
+
+@lru_cache(maxsize=None)
+def get_revisit_log(filename: str) -> RevisitLog:
+    return RevisitLog(filename)
 
 def add_to_revisit_list(item_ref: ItemReference, filename: str = "output/items-to-revisit.txt") -> None:
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, 'a', encoding='utf-8') as f:
-        f.write(f"{item_ref.provider},{item_ref.sheet_name},{item_ref.id}\n")
+    get_revisit_log(filename).write(item_ref)
 
 def load_merges_from_json(filename: str) -> List[ItemMerge]:
-    with open(filename, 'r') as f:
-        data = json.load(f)
-    return [deserialize_merge(item) for item in data]
+    return list(iter_merges_from_json(filename))
+
+def iter_merges_from_json(filename: str) -> Iterator[ItemMerge]:
+    # Yields merges as each line is parsed, so callers can index them without building a list first
+    with open(filename, 'rb') as f:
+        first_line = f.readline()
+        while first_line and not first_line.strip():
+            first_line = f.readline()
+
+        # Older checkpoints are a single JSON array rather than one merge per line
+        if first_line.lstrip().startswith(b"["):
+            yield from map(deserialize_merge, orjson.loads(first_line + f.read()))
+            return
+
+        # Each line is parsed once the next one is read, so the last line can be told apart
+        previous_line = first_line
+        for line in f:
+            if line.strip():
+                yield deserialize_merge(orjson.loads(previous_line))
+                previous_line = line
+        if previous_line:
+            try:
+                last_merge = deserialize_merge(orjson.loads(previous_line))
+            except orjson.JSONDecodeError:
+                # A crash mid-append can leave the last line torn; that merge is just redone
+                print(f"WARNING: Dropping incomplete last line of {filename}")
+                return
+            yield last_merge
+
+MERGE_TABLE_MATCH_TYPE_LABELS: Dict[Optional[MatchType], str] = {
+    None: "(Original)",
+    MatchType.ExactCode: "Matched",
+    MatchType.StrongLLM: "Matched",
+    MatchType.HazyLLM: "Hazy Match",
+}
 
 def to_merge_table_match_type(match_type: Optional[MatchType]) -> str:
-    match match_type:
-        case None:
-            return "(Original)"
-        case MatchType.ExactCode | MatchType.StrongLLM:
-            return "Matched"
-        case MatchType.HazyLLM:
-            return "Hazy Match"
-
-def to_merge_table_row_section(section_input: Optional[ItemOutput]) -> list:
+    return MERGE_TABLE_MATCH_TYPE_LABELS.get(match_type)
+
+NO_MATCH_ROW_SECTION = ('No Match',) + (None,) * 10
+
+def to_merge_table_row_section(section_input: Optional[ItemOutput]) -> tuple:
     if section_input is None:
-        return ['No Match'] + [None] * 10
+        return NO_MATCH_ROW_SECTION
     
-    return [
+    # Source values are already strings/numbers, and None is written as a blank cell
+    return (
         to_merge_table_match_type(section_input.match_type),
-        str(section_input.category_id) if section_input.category_id is not None else '',
-        str(section_input.category_name) if section_input.category_name is not None else '',
+        section_input.category_id,
+        section_input.category_name,
         'INV' if section_input.is_inventory else 'NI',
         section_input.id,
-        str(section_input.code) if section_input.code is not None else '',
-        str(section_input.name) if section_input.name is not None else '',
-        str(section_input.description) if section_input.description is not None else '',
-        str(section_input.intacct_gl_group) if section_input.intacct_gl_group is not None else '',
-        str(section_input.unit_of_measure) if section_input.unit_of_measure is not None else '',
-        float(section_input.cost) if section_input.cost is not None else 0.0,
-    ]
+        section_input.code,
+        section_input.name,
+        section_input.description,
+        section_input.intacct_gl_group,
+        section_input.unit_of_measure,
+        section_input.cost,
+    )
 
 def to_merge_table_row(row_input: list[Optional[ItemOutput]]) -> list:
-    return list(chain.from_iterable(
-        to_merge_table_row_section(item_data) for item_data in row_input
-    ))
+    row = []
+    for item_data in row_input:
+        row.extend(to_merge_table_row_section(item_data))
+    return row
+
+MERGE_TABLE_SECTION_HEADERS = (
+    "Match Type",
+    "Category ID",
+    "Category Name",
+    "Inventory/Non-Inventory?",
+    "ID", 
+    "Code",
+    "Name",
+    "Description",
+    "Intacct GL Group",
+    "UOM",
+    "Cost"
+)
 
-def output_merge_table(file_name: str, output_data: list[list[Optional[ItemOutput]]]):
-    print(f"Outputting merge table to {file_name}")
+MERGE_TABLE_WRITERS = ("openpyxl", "xlsxwriter")
 
-    workbook = Workbook()
-    sheet = workbook.active
-    sheet.title = "Merge Result"
+def output_merge_table(file_name: str, output_data: list[list[Optional[ItemOutput]]], writer: str = "openpyxl"):
+    if not output_data:
+        print(f"No merge table rows to output to {file_name}")
+        return
     
-    section_headers = [
-        "Match Type",
-        "Category ID",
-        "Category Name",
-        "Inventory/Non-Inventory?",
-        "ID", 
-        "Code",
-        "Name",
-        "Description",
-        "Intacct GL Group",
-        "UOM",
-        "Cost"
-    ]
-    sheet.append(section_headers * len(output_data[0]))
+    print(f"Outputting merge table to {file_name} ({writer})")
+
+    header = MERGE_TABLE_SECTION_HEADERS * len(output_data[0])
+    rows = report_row_progress(map(to_merge_table_row, output_data), len(output_data))
+    if writer == "openpyxl":
+        write_table_openpyxl(file_name, header, rows)
+    elif writer == "xlsxwriter":
+        write_table_xlsxwriter(file_name, header, rows)
+    else:
+        raise ValueError(f"Unknown merge table writer: {writer}")
+
+def report_row_progress(rows: Iterable[list], row_count: int) -> Iterator[list]:
+    for index, row in enumerate(rows, 1):
+        yield row
+        if index % 100 == 0:
+            print(f"Processed {index} of {row_count} rows")
+
+def write_table_openpyxl(file_name: str, header: tuple, rows: Iterable[list]) -> None:
+    # Write-only mode streams rows to disk instead of keeping every cell in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Merge Result")
     
-    for index, row_data in enumerate(output_data):
-        row = to_merge_table_row(row_data)
+    sheet.append(header)
+    for row in rows:
         sheet.append(row)
-        if (index + 1) % 100 == 0:
-            print(f"Processed {index + 1} of {len(output_data)} rows")
     
     workbook.save(file_name)
-    workbook.close()
\ No newline at end of file
+    workbook.close()
+
+def write_table_xlsxwriter(file_name: str, header: tuple, rows: Iterable[list]) -> None:
+    # Optional backend, only imported when selected
+    import xlsxwriter
+
+    # Constant memory mode flushes each row to disk once the next one starts
+    workbook = xlsxwriter.Workbook(file_name, {'constant_memory': True})
+    sheet = workbook.add_worksheet("Merge Result")
+    
+    sheet.write_row(0, 0, header)
+    for row_index, row in enumerate(rows, 1):
+        sheet.write_row(row_index, 0, row)
+    
+    workbook.close()
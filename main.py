@@ -8,6 +8,9 @@ from merge import Merge
 from sheet import load_workbooks
 from vector import VectorStore
 from ai import GeminiClient
+from cache import EmbeddingCache, ResponseCache
+from io_util import MERGE_TABLE_WRITERS
+from semantic_cache import SemanticCache
 
 load_dotenv()
 
@@ -23,22 +26,68 @@ def main():
     parser.add_argument(
         '--checkpoint-file',
         default='output/merges.json', 
-        help='Input JSON file for loading & incrementally saving merges (default: output/merges.json)'
+        help='JSON lines file for loading & incrementally saving merges; older JSON array checkpoints are also accepted (default: output/merges.json)'
     )
     parser.add_argument(
         '--output-file',
         default='output/merge-table.xlsx', 
         help='Output Excel file (default: output/merge-table.xlsx)'
     )
+    parser.add_argument(
+        '--writer',
+        default='openpyxl',
+        choices=MERGE_TABLE_WRITERS,
+        help='Library used to write the output Excel file (default: openpyxl)'
+    )
+    parser.add_argument(
+        '--max-llm-workers',
+        type=int,
+        default=Merge.MAX_LLM_WORKERS,
+        help=f'Maximum number of item batches matched concurrently (default: {Merge.MAX_LLM_WORKERS})'
+    )
+    parser.add_argument(
+        '--llm-batch-size',
+        type=int,
+        default=os.getenv('LLM_BATCH_SIZE', str(Merge.LLM_BATCH_SIZE)),
+        help=f'Number of items matched per LLM request; also read from LLM_BATCH_SIZE (default: {Merge.LLM_BATCH_SIZE})'
+    )
+    parser.add_argument(
+        '--embedding-cache-file',
+        default='output/embedding-cache.sqlite',
+        help='SQLite file for caching item embeddings across runs (default: output/embedding-cache.sqlite)'
+    )
+    parser.add_argument(
+        '--response-cache-file',
+        default='output/response-cache.sqlite',
+        help='SQLite file for reusing AI match responses to identical prompts across runs (default: output/response-cache.sqlite)'
+    )
+    parser.add_argument(
+        '--semantic-cache-file',
+        help=(
+            'JSON lines file for caching AI match responses by query embedding similarity (default: disabled). '
+            'A cached match is reused for any item similar enough to an earlier one, so items that differ only '
+            'in size or dimensions can be given the same match'
+        )
+    )
+    parser.add_argument(
+        '--semantic-cache-threshold',
+        type=float,
+        default=SemanticCache.SIMILARITY_THRESHOLD,
+        help=f'Minimum cosine similarity for reusing a cached AI match response (default: {SemanticCache.SIMILARITY_THRESHOLD})'
+    )
     
     args = parser.parse_args()
+    if args.max_llm_workers < 1:
+        parser.error("--max-llm-workers must be at least 1")
+    if args.llm_batch_size < 1:
+        parser.error("--llm-batch-size must be at least 1")
     
     api_key = args.api_key or os.getenv('GEMINI_API_KEY')
     if not api_key:
         print("Error: API key must be provided via --api-key argument or GEMINI_API_KEY environment variable")
         sys.exit(1)
 
-    ai_client = GeminiClient(api_key)
+    ai_client = GeminiClient(api_key, EmbeddingCache(args.embedding_cache_file), ResponseCache(args.response_cache_file))
 
     qdrant_url = os.getenv('QDRANT_API_URL')
     qdrant_api_key = os.getenv('QDRANT_API_KEY')
@@ -56,8 +105,12 @@ def main():
 
     # vector_store.store_embeddings(ai_client, workbooks) # already done
 
-    merger = Merge(workbooks, Provider.Haller, ai_client, vector_store, args.checkpoint_file)
-    merger.merge(args.output_file)
+    semantic_cache = None
+    if args.semantic_cache_file:
+        semantic_cache = SemanticCache(ai_client, args.semantic_cache_file, args.semantic_cache_threshold)
+
+    merger = Merge(workbooks, Provider.Haller, ai_client, vector_store, args.checkpoint_file, semantic_cache, args.max_llm_workers, args.llm_batch_size)
+    merger.merge(args.output_file, args.writer)
 
     print("Done!")
     
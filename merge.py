@@ -1,21 +1,42 @@
-from collections import defaultdict
-from typing import DefaultDict, Optional, Union
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import BinaryIO, Iterable, Optional
 from notification import send_push_notification
+from qdrant_client.models import Filter
 from sheet import ProviderItem, ProviderWorkbook
 from ai import AIMatchType, AIResponse, GeminiClient
-from io_util import file_exists, load_merges_from_json, output_merge_table, save_merges_to_json
+from io_util import append_merges_to_ndjson, file_exists, iter_merges_from_json, output_merge_table, save_merges_to_ndjson
+from semantic_cache import SemanticCache
 from type import ExactCodeMatch, HazyLLMMatch, StrongLLMMatch, ItemMerge, ItemReference, ItemOutput, NoMatch, Provider, sorted_providers
 from vector import VectorStore
 
 class Merge:
-    CHECKPOINT_INTERVAL = 2
+    CHECKPOINT_INTERVAL = 25 # New merges pending before they are appended to the checkpoint
+    LLM_BATCH_SIZE = 4 # Default items matched per LLM request (returns diminish past ~8)
+    MAX_LLM_WORKERS = 8 # Default concurrent LLM batches
     
-    def __init__(self, workbooks: dict[Provider, ProviderWorkbook], reference_provider: Provider, ai_client: GeminiClient, vector_store: VectorStore, checkpoint_file: str = None):
+    def __init__(self, workbooks: dict[Provider, ProviderWorkbook], reference_provider: Provider, ai_client: GeminiClient, vector_store: VectorStore, checkpoint_file: str = None, semantic_cache: Optional[SemanticCache] = None, max_llm_workers: int = MAX_LLM_WORKERS, llm_batch_size: int = LLM_BATCH_SIZE):
         self.__workbooks = workbooks
         self.reference_provider = reference_provider
+        # Reference provider first, then the rest alphabetically
+        self.__ordered_providers: tuple[Provider, ...] = (reference_provider, *(p for p in sorted_providers if p != reference_provider))
         self.__ai_client = ai_client
         self.__vector_store = vector_store
         self.__checkpoint_file = checkpoint_file
+        self.__checkpoint_handle: Optional[BinaryIO] = None
+        self.__semantic_cache = semantic_cache
+        self.__max_llm_workers = max_llm_workers
+        self.__llm_batch_size = llm_batch_size
+        # Items are looked up by ref for every LLM candidate and output cell, so resolve them all once up front
+        self.__item_cache: dict[ItemReference, ProviderItem] = {
+            item_ref: item
+            for workbook in workbooks.values()
+            for item_ref, item in zip(workbook.item_refs, workbook.items)
+        }
+        # Exact code matching runs for every item, so look codes up in one step (codes are unique per workbook)
+        self.__reference_items_by_code: dict[str, ProviderItem] = {
+            item.code: item for item in self.reference_workbook.items
+        }
 
     def workbook(self, provider: Provider) -> ProviderWorkbook:
         return self.__workbooks[provider]
@@ -25,8 +46,10 @@ class Merge:
         return self.workbook(self.reference_provider)
     
     def get_item_by_ref(self, item_ref: ItemReference) -> ProviderItem:
-        workbook = self.workbook(item_ref.provider)
-        return workbook.get_item_by_ref(item_ref)
+        item = self.__item_cache.get(item_ref)
+        if item is None:
+            raise ValueError(f"Item not found: {item_ref}")
+        return item
     
     def get_item_by_id_or_code(self, provider: Provider, id: int, code: str) -> ProviderItem | None:
         workbook = self.workbook(provider)
@@ -38,82 +61,130 @@ class Merge:
                 print(f"Code lookup failed for {provider}: {code}")
         return item
 
-    def merge(self, output_file: str):
-        merges = self.__merge_all()
-        coalesced_merges = self.__coalesce_merges(merges)
-        output_data = self.__to_output_data(coalesced_merges)
-        output_merge_table(output_file, output_data)
+    def merge(self, output_file: str, writer: str = "openpyxl"):
+        try:
+            merges = self.__merge_all()
+        finally:
+            self.__close_checkpoint()
+        output_data = self.__to_output_data(merges)
+        output_merge_table(output_file, output_data, writer)
 
     def __merge_all(self) -> list[ItemMerge]:
         [prior_merge_lookup, _] = self.__load_prior_merges()
+        self.__reset_checkpoint(list(prior_merge_lookup.values()))
         item_merges: list[ItemMerge] = []
+        new_merges: list[ItemMerge] = [] # Merges not yet appended to the checkpoint
         for provider in sorted_providers:
             if provider == self.reference_provider:
                 print(f"Skipping reference provider: {provider}")
                 continue
             workbook = self.workbook(provider) 
-            print(f"Merging provider: {provider} ({len(workbook.item_refs)} items)") 
+            item_refs = workbook.item_refs
+            print(f"Merging provider: {provider} ({len(item_refs)} items)") 
             
-            reference_filters = self.__get_reference_filters(provider, item_merges)
+            # Resuming past a provider that the checkpoint already covers, so there's nothing to dispatch
+            prior_provider_merges = [prior_merge_lookup.get(item_ref) for item_ref in item_refs]
+            if item_refs and all(item_merge is not None for item_merge in prior_provider_merges):
+                print(f"All items for provider {provider} found in checkpoint")
+                item_merges.extend(prior_provider_merges)
+                continue
             
-            for idx, item_ref in enumerate(workbook.item_refs):
-                if idx % self.CHECKPOINT_INTERVAL == 0:
-                    print(f"Checkpoint: Provider ({provider}) index: {idx} of {len(workbook.item_refs) - 1}")
-                    self.__save_checkpoint(item_merges)
-                if item_ref in prior_merge_lookup:
-                    item_merges.append(prior_merge_lookup[item_ref])
+            reference_filters = self.__get_reference_filters()
+            # Built once per provider, since every batch of this provider searches the same references
+            reference_filter = self.__vector_store.build_filter(reference_filters)
+            
+            # Resolve checkpointed and exact code matches up front, so LLM batches only hold items that need the LLM
+            provider_merges: dict[ItemReference, ItemMerge] = {}
+            llm_items: list[ProviderItem] = []
+            for item_ref, prior_merge in zip(item_refs, prior_provider_merges):
+                if prior_merge is not None:
+                    provider_merges[item_ref] = prior_merge
                     continue
-                item = self.get_item_by_ref(item_ref)
+                item = self.__item_cache[item_ref]
+                code_merge = self.__match_by_code(item)
+                if code_merge is not None:
+                    provider_merges[item_ref] = code_merge
+                    new_merges.append(code_merge)
+                else:
+                    llm_items.append(item)
+            self.__save_checkpoint(new_merges)
+            
+            batches = [llm_items[i:i + self.__llm_batch_size] for i in range(0, len(llm_items), self.__llm_batch_size)]
+            print(f"Matching {len(llm_items)} items with LLM in {len(batches)} batches")
+            # Batches are independent network calls, so run them concurrently
+            with ThreadPoolExecutor(max_workers=self.__max_llm_workers) as executor:
+                remaining_batches = iter(batches)
+                futures: dict[Future, list[ProviderItem]] = {}
+                completed = 0
                 try:
-                    item_merge = self.__merge_item(item, reference_filters)
-                    item_merges.append(item_merge)
-                except Exception as e:
-                    self.__save_checkpoint(item_merges)
-                    send_push_notification("Script Failed", str(e))
-                    raise e
+                    while True:
+                        # Only keep a couple of batches queued per worker, so stopping early leaves little work behind
+                        for batch in islice(remaining_batches, 2 * self.__max_llm_workers - len(futures)):
+                            futures[executor.submit(self.__match_with_llm, batch, reference_filter)] = batch
+                        if not futures:
+                            break
+                        # Checkpoint batches as they finish, so one slow request doesn't hold back the rest
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            for item, item_merge in zip(futures.pop(future), future.result()):
+                                provider_merges[item.to_item_ref()] = item_merge
+                                new_merges.append(item_merge)
+                            completed += 1
+                        if len(new_merges) >= self.CHECKPOINT_INTERVAL:
+                            print(f"Checkpoint: Provider ({provider}) batch: {completed} of {len(batches)}")
+                            self.__save_checkpoint(new_merges)
+                except BaseException as e:
+                    # Also on Ctrl-C, so queued batches aren't run (and paid for) on the way out
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self.__save_checkpoint(new_merges)
+                    if isinstance(e, Exception):
+                        send_push_notification("Script Failed", str(e))
+                    raise
+            
+            # Keep merges in workbook order, whatever order the batches finished in
+            item_merges.extend(provider_merges[item_ref] for item_ref in item_refs)
+        self.__save_checkpoint(new_merges)
         send_push_notification("Script Completed", f"Merged {len(item_merges)} items")
         return item_merges
     
-    def __get_reference_filters(self, current_provider: Provider, merges: list[ItemMerge]) -> list[Union[Provider, ItemReference]]:
-        ref_filters: list[Union[Provider, ItemReference]] = []
-        ordered_providers: list[Provider] = [self.reference_provider] + [p for p in sorted_providers if p != self.reference_provider]
-        for provider in ordered_providers:
-            if provider == current_provider:
-                break
-            if provider == self.reference_provider:
-                ref_filters.append(provider)
-                break
-            for merge in merges:
-                if isinstance(merge, NoMatch) and merge.query.provider == provider:
-                    ref_filters.append(merge.query)
-
-        return ref_filters
+    def __get_reference_filters(self) -> list[Provider]:
+        # Every provider is matched against the reference provider's items
+        return [self.reference_provider]
     
-    def __merge_item(self, item: ProviderItem, reference_filters: list[Union[Provider, ItemReference]]) -> ItemMerge:
-        # Exact code match
-        reference_workbook = self.workbook(self.reference_provider)
-        matching_code_item = reference_workbook.get_item_by_code(item.code)
-        if matching_code_item is not None:
-            return ExactCodeMatch(
-                query=item.to_item_ref(),
-                match=matching_code_item.to_item_ref()
-            )
-        
-        # LLM-based match
-        return self.__match_with_llm(item, reference_filters)
+    def __match_by_code(self, item: ProviderItem) -> Optional[ExactCodeMatch]:
+        matching_code_item = self.__reference_items_by_code.get(item.code)
+        if matching_code_item is None:
+            return None
+        return ExactCodeMatch(
+            query=item.to_item_ref(),
+            match=matching_code_item.to_item_ref()
+        )
     
-    def __match_with_llm(self, item: ProviderItem, reference_filters: list[Union[Provider, ItemReference]]) -> ItemMerge:
-        # First filter for relevant reference items
-        relevant_items = self.__vector_store.get_relevant_items(item.to_item_ref(), reference_filters)
-        full_reference_items = [self.get_item_by_ref(item_ref) for item_ref in relevant_items]
+    def __match_with_llm(self, items: list[ProviderItem], reference_filter: Filter) -> list[ItemMerge]:
+        # First filter for relevant reference items, matching the batch against the union of each item's results
+        query_embeddings = self.__vector_store.fetch_embeddings([item.to_item_ref() for item in items])
+        relevant_items: dict[ItemReference, None] = {}
+        for item_relevant_items in self.__vector_store.get_relevant_items_by_embedding(query_embeddings, reference_filter):
+            relevant_items.update(dict.fromkeys(item_relevant_items))
+        full_reference_items = [self.__item_cache[item_ref] for item_ref in relevant_items]
 
-        match_result = self.__ai_client.generate_match_response_advanced(full_reference_items, item)
+        if self.__semantic_cache is not None:
+            # The stored embeddings are the same ones the cache would request, so don't embed the items again
+            match_results = self.__semantic_cache.generate_match_response_batch(full_reference_items, items, query_embeddings)
+        else:
+            match_results = self.__ai_client.generate_match_response_batch(full_reference_items, items)
+        return [
+            self.__resolve_llm_match(item, match_result, full_reference_items)
+            for item, match_result in zip(items, match_results)
+        ]
+    
+    def __resolve_llm_match(self, item: ProviderItem, match_result: AIResponse, reference_items: list[ProviderItem]) -> ItemMerge:
         merge = self.__evaluate_llm_match(item, match_result)
         if merge is not None:
             return merge
         
         print(f"Initial AI match didn't return valid item, attempting follow-up match")
-        match_result = self.__ai_client.generate_followup_match_response(full_reference_items, item, match_result)
+        match_result = self.__ai_client.generate_followup_match_response(reference_items, item, match_result)
         merge = self.__evaluate_llm_match(item, match_result)
         if merge is not None:
             return merge
@@ -137,73 +208,80 @@ class Merge:
         if self.__checkpoint_file is None or not file_exists(self.__checkpoint_file):
             return {}, {}
         
-        prior_merges = load_merges_from_json(self.__checkpoint_file)
-        return index_merges(prior_merges)
+        return index_merges(iter_merges_from_json(self.__checkpoint_file))
     
-    def __save_checkpoint(self, merges: list[ItemMerge]) -> None:
-        save_merges_to_json(merges, self.__checkpoint_file)
+    def __reset_checkpoint(self, merges: list[ItemMerge]) -> None:
+        # Rewrite prior merges once (compacting older array checkpoints), then only append through one open handle
+        if self.__checkpoint_file is None:
+            return
+        save_merges_to_ndjson(merges, self.__checkpoint_file)
+        self.__checkpoint_handle = open(self.__checkpoint_file, 'ab')
 
-    def __coalesce_merges(self, merges: list[ItemMerge]) -> list[tuple[ItemReference, list[ItemMerge]]]:
-        result: list[tuple[ItemReference, list[ItemMerge]]] = []
-        [query_to_merge, match_to_merges] = index_merges(merges)
+    def __save_checkpoint(self, new_merges: list[ItemMerge]) -> None:
+        if self.__checkpoint_handle is None or not new_merges:
+            return
+        append_merges_to_ndjson(new_merges, self.__checkpoint_handle)
+        new_merges.clear()
 
-        ordered_providers: list[Provider] = [self.reference_provider] + [p for p in sorted_providers if p != self.reference_provider]
-        for provider in ordered_providers:
-            workbook = self.workbook(provider)
-            for item_ref in workbook.item_refs:
-                merged_items = match_to_merges[item_ref] if item_ref in match_to_merges else []
-                matched_item = query_to_merge.get(item_ref)
-                if matched_item is None or isinstance(matched_item, NoMatch):
-                    result.append((item_ref, merged_items))
-        
-        return result
-    
-    def __to_output_data(self, coalesced_merges: list[tuple[ItemReference, list[ItemMerge]]]) -> list[list[Optional[ItemOutput]]]:
+    def __close_checkpoint(self) -> None:
+        if self.__checkpoint_handle is None:
+            return
+        self.__checkpoint_handle.close()
+        self.__checkpoint_handle = None
+
+    def __to_output_data(self, merges: list[ItemMerge]) -> list[list[Optional[ItemOutput]]]:
+        # Coalesces merges onto their base (unmatched) items and emits the output rows in a single pass
         output_data: list[list[Optional[ItemOutput]]] = []
-        ordered_providers: list[Provider] = [self.reference_provider] + [p for p in sorted_providers if p != self.reference_provider]
+        [query_to_merge, match_to_merges_by_provider] = index_merges_by_match_provider(merges)
         
-        for (base_ref, merges) in coalesced_merges:
-            merges_by_provider = group_merges_by_provider(merges)
-            
-            # Find the maximum number of merges for any provider
-            max_merges_per_provider = 1
-            for provider in ordered_providers:
-                if provider != base_ref.provider:
-                    merges_for_provider = merges_by_provider[provider]
-                    max_merges_per_provider = max(max_merges_per_provider, len(merges_for_provider))
-            
-            # Create rows for each merge combination
-            for merge_index in range(max_merges_per_provider):
-                row_data: list[Optional[ItemOutput]] = []
-                for provider in ordered_providers:
-                    if provider == base_ref.provider:
-                        item = self.get_item_by_ref(base_ref)
-                        row_data.append(item.to_item_output(None))
-                        continue
-                    
-                    merges_for_provider = merges_by_provider[provider]
-                    if merge_index < len(merges_for_provider):
-                        merge_for_provider = merges_for_provider[merge_index]
-                        item = self.get_item_by_ref(merge_for_provider.query)
-                        item_output = item.to_item_output(merge_for_provider.type)
-                        row_data.append(item_output)
-                    else:
-                        row_data.append(None)
-                output_data.append(row_data)
+        for base_provider in self.__ordered_providers:
+            for base_ref in self.workbook(base_provider).item_refs:
+                matched_item = query_to_merge.get(base_ref)
+                if matched_item is not None and not matched_item.IS_NO_MATCH:
+                    continue # Output in the row of the item it matched
+                
+                merges_by_provider = match_to_merges_by_provider.get(base_ref, {})
+                base_output = self.__item_cache[base_ref].to_item_output(None)
+                
+                # Find the maximum number of merges for any provider
+                max_merges_per_provider = 1
+                for provider, merges_for_provider in merges_by_provider.items():
+                    if provider != base_provider:
+                        max_merges_per_provider = max(max_merges_per_provider, len(merges_for_provider))
+                
+                # Create rows for each merge combination
+                for merge_index in range(max_merges_per_provider):
+                    row_data: list[Optional[ItemOutput]] = []
+                    for provider in self.__ordered_providers:
+                        if provider == base_provider:
+                            row_data.append(base_output)
+                            continue
+                        
+                        merges_for_provider = merges_by_provider.get(provider, [])
+                        if merge_index < len(merges_for_provider):
+                            merge_for_provider = merges_for_provider[merge_index]
+                            item_output = self.__item_cache[merge_for_provider.query].to_item_output(merge_for_provider.type)
+                            row_data.append(item_output)
+                        else:
+                            row_data.append(None)
+                    output_data.append(row_data)
         
         return output_data
     
-def index_merges(merges: list[ItemMerge]) -> tuple[dict[ItemReference, ItemMerge], dict[ItemReference, ItemMerge]]:
+def index_merges(merges: Iterable[ItemMerge]) -> tuple[dict[ItemReference, ItemMerge], dict[ItemReference, ItemMerge]]:
     query_to_merge: dict[ItemReference, ItemMerge] = {}
-    match_to_merges: DefaultDict[ItemReference, list[ItemMerge]] = defaultdict(list)
+    match_to_merges: dict[ItemReference, list[ItemMerge]] = {}
     for merge in merges:
         query_to_merge[merge.query] = merge
-        if not isinstance(merge, NoMatch):
-            match_to_merges[merge.match].append(merge)
+        if not merge.IS_NO_MATCH:
+            match_to_merges.setdefault(merge.match, []).append(merge)
     return query_to_merge, match_to_merges
 
-def group_merges_by_provider(merges: list[ItemMerge]) -> dict[Provider, list[ItemMerge]]:
-    result: DefaultDict[Provider, list[ItemMerge]] = defaultdict(list)
+def index_merges_by_match_provider(merges: list[ItemMerge]) -> tuple[dict[ItemReference, ItemMerge], dict[ItemReference, dict[Provider, list[ItemMerge]]]]:
+    query_to_merge: dict[ItemReference, ItemMerge] = {}
+    match_to_merges_by_provider: dict[ItemReference, dict[Provider, list[ItemMerge]]] = {}
     for merge in merges:
-        result[merge.query.provider].append(merge)
-    return result
\ No newline at end of file
+        query_to_merge[merge.query] = merge
+        if not merge.IS_NO_MATCH:
+            match_to_merges_by_provider.setdefault(merge.match, {}).setdefault(merge.query.provider, []).append(merge)
+    return query_to_merge, match_to_merges_by_provider
\ No newline at end of file
@@ -0,0 +1,50 @@
+import random
+import threading
+import time
+from typing import Optional
+from google.genai import errors
+
+RETRY_BASE_DELAY = 10 # Seconds, doubled per attempt
+MAX_RETRY_DELAY = 60 # Gemini request quota is per minute
+
+
+class RateLimitCooldown:
+    """Back-off window shared by all threads, so one 429 pauses every worker instead of each discovering it separately."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__cooldown_until = 0.0
+
+    def extend(self, delay: float) -> None:
+        with self.__lock:
+            self.__cooldown_until = max(self.__cooldown_until, time.monotonic() + delay)
+
+    def wait(self) -> None:
+        with self.__lock:
+            remaining = self.__cooldown_until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+rate_limit_cooldown = RateLimitCooldown()
+
+
+def parse_retry_delay(error: errors.ClientError) -> Optional[float]:
+    try:
+        error_details = error.details.get('error', error.details)
+        for detail in error_details.get('details', []):
+            if detail.get('@type') == 'type.googleapis.com/google.rpc.RetryInfo':
+                return float(detail['retryDelay'].rstrip('s'))
+    except (AttributeError, KeyError, ValueError, TypeError):
+        pass
+    return None
+
+
+def wait_for_rate_limit(error: errors.ClientError, attempt: int, max_retries: int) -> None:
+    retry_delay = parse_retry_delay(error)
+    if retry_delay is None:
+        retry_delay = min(MAX_RETRY_DELAY, RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, 5))
+
+    print(f"Rate limited (429). Retrying in {retry_delay:.0f} seconds... (attempt {attempt + 1}/{max_retries + 1})")
+    rate_limit_cooldown.extend(retry_delay)
+    rate_limit_cooldown.wait()
@@ -0,0 +1,113 @@
+import orjson
+import os
+import threading
+from typing import List, Optional
+import numpy as np
+from ai import FALLBACK_NO_MATCH_REASONING, AIMatchType, AIResponse, GeminiClient
+from sheet import ProviderItem
+from similarity import normalize_embedding, quantize_embeddings, top_k_similar_quantized
+
+
+class SemanticCache:
+    SIMILARITY_THRESHOLD = 0.92
+
+    def __init__(self, ai_client: GeminiClient, filename: str, similarity_threshold: float = SIMILARITY_THRESHOLD):
+        self.__ai_client = ai_client
+        self.__filename = filename
+        self.similarity_threshold = similarity_threshold
+        # Embeddings are kept int8-quantized (one scale per row) to cut resident memory 4x,
+        # in arrays with spare capacity so adding an entry doesn't copy the whole matrix
+        self.__embeddings = np.empty((0, 0), dtype=np.int8)
+        self.__scales = np.empty(0, dtype=np.float32)
+        self.__responses: list[AIResponse] = []
+        self.__lock = threading.Lock() # Batches are matched from several threads
+        self.__load()
+
+    def generate_match_response_advanced(self, reference_items: List[ProviderItem], query_item: ProviderItem) -> AIResponse:
+        [response] = self.generate_match_response_batch(reference_items, [query_item])
+        return response
+
+    def generate_match_response_batch(self, reference_items: List[ProviderItem], query_items: List[ProviderItem], query_embeddings: Optional[List[List[float]]] = None) -> List[AIResponse]:
+        if query_embeddings is None:
+            query_embeddings = [result.embedding for result in self.__ai_client.embed_items(query_items)]
+        embeddings = [normalize_embedding(embedding) for embedding in query_embeddings]
+
+        with self.__lock:
+            responses: list[Optional[AIResponse]] = [self.__lookup(embedding, reference_items) for embedding in embeddings]
+        for query_item, response in zip(query_items, responses):
+            if response is not None:
+                print(f"Semantic cache hit for item {query_item.provider}:{query_item.id}")
+
+        missing_indices = [i for i, response in enumerate(responses) if response is None]
+        if missing_indices:
+            missing_responses = self.__ai_client.generate_match_response_batch(reference_items, [query_items[i] for i in missing_indices])
+            with self.__lock:
+                for i, response in zip(missing_indices, missing_responses):
+                    responses[i] = response
+                    if response.reasoning != FALLBACK_NO_MATCH_REASONING:
+                        self.__add(embeddings[i], response)
+        return responses
+
+    def __lookup(self, embedding: np.ndarray, reference_items: List[ProviderItem]) -> Optional[AIResponse]:
+        count = len(self.__responses)
+        if count == 0:
+            return None
+
+        [best_index], [best_score] = top_k_similar_quantized(embedding, self.__embeddings[:count], self.__scales[:count], 1)
+        if best_score <= self.similarity_threshold:
+            return None
+
+        response = self.__responses[best_index]
+        if response.type != AIMatchType.NoMatch and not is_item_in_references(response, reference_items):
+            return None # Cached match is stale for this reference set
+        return response
+
+    def __add(self, embedding: np.ndarray, response: AIResponse) -> None:
+        [quantized_embedding], [scale] = quantize_embeddings(embedding[np.newaxis, :])
+        self.__append(quantized_embedding, float(scale), response)
+
+        os.makedirs(os.path.dirname(self.__filename) or '.', exist_ok=True)
+        with open(self.__filename, 'ab') as f:
+            f.write(orjson.dumps({
+                "embedding": quantized_embedding,
+                "scale": float(scale),
+                "response": response.model_dump(mode='json')
+            }, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n")
+
+    def __append(self, quantized_embedding: np.ndarray, scale: float, response: AIResponse) -> None:
+        count = len(self.__responses)
+        if count == len(self.__embeddings):
+            # Double the capacity, so growing costs amortized O(1) per entry
+            capacity = max(2 * count, 1024)
+            embeddings = np.empty((capacity, len(quantized_embedding)), dtype=np.int8)
+            scales = np.empty(capacity, dtype=np.float32)
+            if count:
+                embeddings[:count] = self.__embeddings
+                scales[:count] = self.__scales
+            self.__embeddings, self.__scales = embeddings, scales
+        self.__embeddings[count] = quantized_embedding
+        self.__scales[count] = scale
+        self.__responses.append(response)
+
+    def __load(self) -> None:
+        if not os.path.exists(self.__filename):
+            return
+
+        with open(self.__filename, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = orjson.loads(line)
+                self.__append(
+                    np.asarray(entry["embedding"], dtype=np.int8),
+                    entry["scale"],
+                    AIResponse.model_validate(entry["response"])
+                )
+        print(f"Loaded {len(self.__responses)} semantic cache entries")
+
+
+def is_item_in_references(response: AIResponse, reference_items: List[ProviderItem]) -> bool:
+    return any(
+        item.provider == response.item.provider and (item.id == response.item.id or item.code == response.item.code)
+        for item in reference_items
+    )
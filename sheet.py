@@ -1,6 +1,6 @@
+from dataclasses import dataclass
 from openpyxl import load_workbook
 from openpyxl.worksheet.worksheet import Worksheet
-from openpyxl.cell import Cell
 from typing import Dict, Tuple, Optional, Any
 from type import Provider, ItemReference, SheetName, ItemOutput, MatchType
 
@@ -13,22 +13,50 @@ PROVIDER_TO_FILE_NAME: dict[Provider, str] = {
 }
 
 
-class ProviderItem:
-    def __init__(self, provider: Provider, sheet_name: SheetName, data: dict[str, Any]):
-        self.provider = provider
-        self.sheet_name = sheet_name
-        self.__data = data
+# Workbook column backing each ProviderItem field (missing columns read as None)
+PROVIDER_ITEM_COLUMNS: dict[str, str] = {
+    'id': 'Id',
+    'code': 'Code',
+    'category_id': 'Category.ID',
+    'category_name': 'Category.Name',
+    'is_inventory': 'IsInventory',
+    'name': 'Name',
+    'description': 'Description',
+    'intacct_gl_group': 'Intacct GL Group',
+    'unit_of_measure': 'UnitOfMeasure',
+    'cost': 'Cost',
+    'type': 'Type',
+    'brand': 'Brand',
+    'manufacturer': 'Manufacturer',
+    'model': 'Model',
+}
 
-    @property
-    def id(self) -> int:
-        return self.__data['Id']
-    
-    @property
-    def code(self) -> str:
-        return self.__data['Code']
-    
-    def get(self, key: str) -> Any:
-        return self.__data.get(key)
+
+# Identity equality/hashing (eq=False), since items are used as cache keys
+@dataclass(slots=True, eq=False)
+class ProviderItem:
+    provider: Provider
+    sheet_name: SheetName
+    id: int
+    code: str
+    category_id: Optional[str]
+    category_name: Optional[str]
+    is_inventory: bool
+    name: Optional[str]
+    description: Optional[str]
+    intacct_gl_group: Optional[str]
+    unit_of_measure: Optional[str]
+    cost: Optional[float]
+    type: Optional[str]
+    brand: Optional[str]
+    manufacturer: Optional[str]
+    model: Optional[str]
+
+    @classmethod
+    def from_row(cls, provider: Provider, sheet_name: SheetName, row: Tuple[Any, ...], column_indices: dict[str, Optional[int]]) -> 'ProviderItem':
+        fields = {field: row[index] if index is not None else None for field, index in column_indices.items()}
+        fields['is_inventory'] = fields['is_inventory'] == 1
+        return cls(provider, sheet_name, **fields)
 
     def to_item_ref(self) -> ItemReference:
         return ItemReference(
@@ -40,16 +68,16 @@ class ProviderItem:
     def to_item_output(self, match_type: MatchType | None = None) -> ItemOutput:
         return ItemOutput(
             match_type = match_type,
-            category_id=self.get('Category.ID'),
-            category_name=self.get('Category.Name'),
-            is_inventory=self.get('IsInventory') == 1,
+            category_id=self.category_id,
+            category_name=self.category_name,
+            is_inventory=self.is_inventory,
             id=self.id,
             code=self.code,
-            name=self.get('Name'),
-            description=self.get('Description'),
-            intacct_gl_group=self.get('Intacct GL Group'),
-            unit_of_measure=self.get('UnitOfMeasure'),
-            cost=self.get('Cost')
+            name=self.name,
+            description=self.description,
+            intacct_gl_group=self.intacct_gl_group,
+            unit_of_measure=self.unit_of_measure,
+            cost=self.cost
         )
 
 
@@ -60,14 +88,15 @@ class ProviderSheet:
         self.__sheet: Worksheet = sheet
         self.__column_lookup: dict[str, int] = self.__create_column_lookup()
         
-        rows = list(self.__sheet.iter_rows(min_row=2, max_col=sheet.max_column, max_row=sheet.max_row))
+        # Plain value tuples, so no Cell objects are built for the data rows
+        rows = self.__sheet.iter_rows(min_row=2, max_col=sheet.max_column, max_row=sheet.max_row, values_only=True)
         
         self.__items: list[ProviderItem] = []
         self.__id_to_index: dict[int, int] = {}
         self.__code_to_id: dict[str, int] = {}
+        column_indices = {field: self.__column_lookup.get(column) for field, column in PROVIDER_ITEM_COLUMNS.items()}
         for index, row in enumerate(rows):
-            item_data = self.__row_to_item_data(row)
-            item = ProviderItem(self.provider, self.sheet_name, item_data)
+            item = ProviderItem.from_row(self.provider, self.sheet_name, row, column_indices)
             self.__items.append(item)
 
             # Populate ID -> row index lookup
@@ -86,9 +115,11 @@ class ProviderSheet:
                 raise ValueError(f"Duplicate code: {code}")
             self.__code_to_id[code] = id
 
+        self.__item_refs: tuple[ItemReference, ...] = tuple(item.to_item_ref() for item in self.__items)
+
     @property
-    def item_refs(self) -> list[ItemReference]:
-        return [item.to_item_ref() for item in self.__items]
+    def item_refs(self) -> tuple[ItemReference, ...]:
+        return self.__item_refs
 
     @property
     def ids(self) -> list[int]:
@@ -112,29 +143,25 @@ class ProviderSheet:
         return self.get_item_by_id(id) if id is not None else None
     
     def __create_column_lookup(self) -> dict[str, int]:
-        column_lookup = {}
-        for index, column in enumerate(self.__sheet.iter_cols(1, self.__sheet.max_column)):
-            column_lookup[column[0].value] = index
-        return column_lookup
-    
-    def __row_to_item_data(self, row: Tuple[Cell, ...]) -> dict[str, Any]:
-        item = {}
-        for column_name, column_index in self.__column_lookup.items():
-            item[column_name] = row[column_index].value
-        return item
+        # Only the header row is read, rather than every cell of every column
+        header_row = next(self.__sheet.iter_rows(min_row=1, max_row=1, max_col=self.__sheet.max_column, values_only=True))
+        return {column_name: index for index, column_name in enumerate(header_row)}
 
 
 class ProviderWorkbook:
     def __init__(self, provider: Provider):
         self.provider = provider
         print(f"Loading workbook for provider: {provider}")
-        self.__workbook = load_workbook(PROVIDER_TO_FILE_NAME[provider])
+        # Read-only mode streams the sheet XML; every value is copied out, so the file is closed right after
+        workbook = load_workbook(PROVIDER_TO_FILE_NAME[provider], read_only=True, data_only=True)
         self.__sheets = {
-            sheet_name: ProviderSheet(self.provider, sheet_name, self.__workbook[sheet_name.value])
+            sheet_name: ProviderSheet(self.provider, sheet_name, workbook[sheet_name.value])
             for sheet_name in SheetName
         }
+        workbook.close()
         
-        self.__item_refs: list[ItemReference] = []
+        item_refs: list[ItemReference] = []
+        items: list[ProviderItem] = []
         self.__id_to_item_ref: dict[int, ItemReference] = {}
         self.__code_to_item_ref: dict[str, ItemReference] = {}
         for sheet in sorted(self.__sheets.values(), key=lambda x: x.sheet_name.value):
@@ -143,7 +170,8 @@ class ProviderWorkbook:
                 if item is None:
                     raise ValueError(f"Item not found: {item_ref}")
                 
-                self.__item_refs.append(item_ref)
+                item_refs.append(item_ref)
+                items.append(item)
 
                 # Populate ID -> item ref lookup
                 if item.id in self.__id_to_item_ref:
@@ -154,6 +182,9 @@ class ProviderWorkbook:
                 if item.code in self.__code_to_item_ref:
                     raise ValueError(f"Duplicate code: {item.code}")
                 self.__code_to_item_ref[item.code] = item_ref
+        # Immutable so callers can't grow the shared list
+        self.__item_refs: tuple[ItemReference, ...] = tuple(item_refs)
+        self.__items: tuple[ProviderItem, ...] = tuple(items)
         print(f"Loaded {len(self.__item_refs)} items")
 
     def get_sheet(self, sheetName: SheetName) -> ProviderSheet:
@@ -163,9 +194,14 @@ class ProviderWorkbook:
         return sheet
     
     @property
-    def item_refs(self) -> list[ItemReference]:
+    def item_refs(self) -> tuple[ItemReference, ...]:
         return self.__item_refs
     
+    @property
+    def items(self) -> tuple[ProviderItem, ...]:
+        # Same order as item_refs
+        return self.__items
+    
     def get_item_by_ref(self, ref: ItemReference) -> ProviderItem:
         sheet = self.get_sheet(ref.sheet_name)
         row = sheet.get_item_by_id(ref.id)
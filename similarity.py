@@ -0,0 +1,36 @@
+import numpy as np
+
+QUANTIZED_SCORE_BLOCK_ROWS = 1024
+
+
+def normalize_embedding(embedding: list[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def top_k_similar_quantized(query: np.ndarray, embeddings: np.ndarray, scales: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns (indices, scores) of the k int8 rows from quantize_embeddings most similar to query, best first.
+    Vectors must be normalized. Scores are approximate."""
+    # Widen fixed-size blocks to float32, so the dot product goes through BLAS without a full-size temporary
+    query = query.astype(np.float32, copy=False)
+    scores = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), QUANTIZED_SCORE_BLOCK_ROWS):
+        block = embeddings[start:start + QUANTIZED_SCORE_BLOCK_ROWS].astype(np.float32)
+        np.matmul(block, query, out=scores[start:start + len(block)])
+    scores *= scales
+    return top_k_scores(scores, k)
+
+
+def top_k_scores(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    k = min(k, len(scores))
+    top_indices = np.argpartition(scores, -k)[-k:] # Unordered top k in O(n)
+    top_indices = top_indices[np.argsort(scores[top_indices])[::-1]]
+    return top_indices, scores[top_indices]
+
+
+def quantize_embeddings(embeddings: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization, returning (int8 rows, float32 scales) where row ~= int8 row * scale."""
+    scales = (np.abs(embeddings).max(axis=1) / 127).astype(np.float32)
+    scales[scales == 0] = 1
+    return np.round(embeddings / scales[:, np.newaxis]).astype(np.int8), scales
@@ -1,6 +1,6 @@
 from enum import StrEnum, auto
-from dataclasses import dataclass
-from typing import Union, Dict, Any
+from dataclasses import dataclass, field
+from typing import ClassVar, Union, Dict, Any
 
 class Provider(StrEnum):
     Haller = auto()
@@ -8,17 +8,30 @@ class Provider(StrEnum):
     Universe = auto()
     WeltmanPrinceton = auto()
 
-sorted_providers = sorted(Provider, key=lambda p: p.value)
+# Alphabetical by value; keep in sync with Provider
+sorted_providers: tuple[Provider, ...] = (Provider.Gem, Provider.Haller, Provider.Universe, Provider.WeltmanPrinceton)
 
 class SheetName(StrEnum):
     Materials = 'Materials'
     Equipment = 'Equipment'
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ItemReference:
     provider: Provider
     sheet_name: SheetName
     id: int
+    _hash: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # References are used as dict keys throughout merging, so hash them once
+        object.__setattr__(self, '_hash', hash((self.provider, self.sheet_name, self.id)))
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __reduce__(self):
+        # Recompute the hash on unpickle, since str hashes differ between processes
+        return (ItemReference, (self.provider, self.sheet_name, self.id))
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -46,6 +59,7 @@ class ExactCodeMatch:
     query: ItemReference
     match: ItemReference
     type: MatchType = MatchType.ExactCode
+    IS_NO_MATCH: ClassVar[bool] = False
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -66,6 +80,7 @@ class StrongLLMMatch:
     query: ItemReference
     match: ItemReference
     type: MatchType = MatchType.StrongLLM
+    IS_NO_MATCH: ClassVar[bool] = False
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -87,6 +102,7 @@ class HazyLLMMatch:
     query: ItemReference
     match: ItemReference
     type: MatchType = MatchType.HazyLLM
+    IS_NO_MATCH: ClassVar[bool] = False
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -106,6 +122,7 @@ class HazyLLMMatch:
 class NoMatch:
     query: ItemReference
     type: MatchType = MatchType.NoMatch
+    IS_NO_MATCH: ClassVar[bool] = True # Checked in hot loops instead of isinstance
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -119,7 +136,7 @@ class NoMatch:
             query=ItemReference.from_dict(data["query"])
         )
 
-ItemMerge = Union[ExactCodeMatch, StrongLLMMatch, NoMatch]
+ItemMerge = Union[ExactCodeMatch, StrongLLMMatch, HazyLLMMatch, NoMatch]
 
 @dataclass(frozen=True)
 class ItemOutput:
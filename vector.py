@@ -1,5 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from qdrant_client import QdrantClient
-from qdrant_client.models import Filter, FieldCondition, MatchValue, PointStruct, Record
+from qdrant_client.models import Filter, FieldCondition, MatchAny, MatchValue, PointStruct, QueryRequest, Record, SearchParams
 from typing import Dict, List, Optional, Union
 import uuid
 from ai import MAX_EMBED_CHUNK_SIZE, GeminiClient
@@ -8,6 +9,16 @@ from type import ItemReference, Provider, SheetName
 
 
 QDRANT_COLLECTION_NAME = "HomeX"
+RELEVANT_ITEMS_LIMIT = 200
+# Larger search beam than the default, to keep recall up with the smaller limit
+RELEVANT_ITEMS_HNSW_EF = 256
+# Only the fields payload_to_item_ref reads
+ITEM_REF_PAYLOAD_FIELDS = ["provider", "id", "sheet_name"]
+MAX_EMBED_WORKERS = 8
+
+# Payload values -> enum members, a plain dict hit instead of an enum constructor call per record
+PROVIDER_BY_VALUE: Dict[str, Provider] = {provider.value: provider for provider in Provider}
+SHEET_NAME_BY_VALUE: Dict[str, SheetName] = {sheet_name.value: sheet_name for sheet_name in SheetName}
 
 class VectorStore():
     def __init__(self, client: QdrantClient):
@@ -39,75 +50,98 @@ class VectorStore():
 
 
     def get_records(self, items: List[ItemReference], with_vectors: bool = False) -> Dict[ItemReference, Record]:
-        records, _ = self.__client.scroll(
-            collection_name=QDRANT_COLLECTION_NAME,
-            scroll_filter=Filter(
-                should=[
-                    Filter(
-                        must=[
-                            FieldCondition(key="provider", match=MatchValue(value=item.provider.value)),
-                            FieldCondition(key="id", match=MatchValue(value=item.id)),
-                        ]
-                    )
-                    for item in items
-                ]
-            ),
-            limit=len(items),
-            with_vectors=with_vectors
+        # One provider condition with an id set per provider, rather than a provider/id pair per item
+        ids_by_provider: Dict[Provider, List[int]] = {}
+        for item in items:
+            ids_by_provider.setdefault(item.provider, []).append(item.id)
+        
+        scroll_filter = Filter(
+            should=[
+                Filter(
+                    must=[
+                        FieldCondition(key="provider", match=MatchValue(value=provider.value)),
+                        FieldCondition(key="id", match=MatchAny(any=ids)),
+                    ]
+                )
+                for provider, ids in ids_by_provider.items()
+            ]
         )
 
+        # Page until exhausted, since an item can have duplicate points (e.g. from a re-run of store_embeddings)
         result: Dict[ItemReference, Record] = {}
-        for record in records:
-            item_ref = payload_to_item_ref(record.payload)
-            result[item_ref] = record
+        offset = None
+        while True:
+            records, offset = self.__client.scroll(
+                collection_name=QDRANT_COLLECTION_NAME,
+                scroll_filter=scroll_filter,
+                limit=len(items),
+                offset=offset,
+                with_vectors=with_vectors
+            )
+            for record in records:
+                result.setdefault(payload_to_item_ref(record.payload), record)
+            if offset is None:
+                break
         
         return result
 
 
-    def store_embeddings(self, ai_client: GeminiClient, workbooks: Dict[Provider, ProviderWorkbook]):
+    def store_embeddings(self, ai_client: GeminiClient, workbooks: Dict[Provider, ProviderWorkbook], max_workers: int = MAX_EMBED_WORKERS):
         for workbook in workbooks.values():
             print(f"Processing embeddings for provider: {workbook.provider}")
 
             item_chunks = chunk_list(workbook.item_refs, MAX_EMBED_CHUNK_SIZE)
-            for idx, item_chunk in enumerate(item_chunks):
-                print(f"Embedding chunk {idx + 1} of {len(item_chunks)} ({workbook.provider})")
-
-                items_to_embed: List[ProviderItem] = []
-                embed_records = self.get_records(item_chunk, True)
-                for item_ref in item_chunk:
-                    if item_ref in embed_records:
-                        continue
-
-                    item = workbook.get_item_by_ref(item_ref)
-                    items_to_embed.append(item)
-
-                if not items_to_embed:
-                    continue
-
-                chunk_embeddings = ai_client.embed_chunk(items_to_embed)
-                chunk_points = [
-                    PointStruct(
-                        id=str(uuid.uuid4()),
-                        vector=embed_result.embedding,
-                        payload={
-                            "provider": embed_result.item.provider.value,
-                            "id": embed_result.item.id,
-                            "sheet_name": embed_result.item.sheet_name.value
-                        }
-                    )
-                    for embed_result in chunk_embeddings
+            # Chunks are independent, so one chunk's upsert overlaps with the next ones' embedding requests
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(self.__store_chunk_embeddings, ai_client, workbook, item_chunk)
+                    for item_chunk in item_chunks
                 ]
-                self.__client.upsert(
-                    collection_name=QDRANT_COLLECTION_NAME,
-                    points=chunk_points
-                )
+                try:
+                    for completed, future in enumerate(as_completed(futures), 1):
+                        future.result()
+                        print(f"Embedded chunk {completed} of {len(item_chunks)} ({workbook.provider})")
+                except BaseException:
+                    # Also on Ctrl-C, so queued chunks aren't embedded and upserted on the way out
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
         
         print("Finished processing embeddings")
 
 
-    def get_relevant_items(self, query: ItemReference, filters: List[Union[Provider, ItemReference]], limit: int = 1500):
-        embedding = self.fetch_embedding(query)
-        
+    def __store_chunk_embeddings(self, ai_client: GeminiClient, workbook: ProviderWorkbook, item_chunk: List[ItemReference]):
+        items_to_embed: List[ProviderItem] = []
+        embed_records = self.get_records(item_chunk, True)
+        for item_ref in item_chunk:
+            if item_ref in embed_records:
+                continue
+
+            item = workbook.get_item_by_ref(item_ref)
+            items_to_embed.append(item)
+
+        if not items_to_embed:
+            return
+
+        chunk_embeddings = ai_client.embed_chunk(items_to_embed)
+        chunk_points = [
+            PointStruct(
+                id=str(uuid.uuid4()),
+                vector=embed_result.embedding,
+                payload={
+                    "provider": embed_result.item.provider.value,
+                    "id": embed_result.item.id,
+                    "sheet_name": embed_result.item.sheet_name.value
+                }
+            )
+            for embed_result in chunk_embeddings
+        ]
+        self.__client.upsert(
+            collection_name=QDRANT_COLLECTION_NAME,
+            points=chunk_points
+        )
+
+
+    def build_filter(self, filters: List[Union[Provider, ItemReference]]) -> Filter:
         # Build filter conditions based on filter type
         filter_conditions = []
         for filter_item in filters:
@@ -126,17 +160,52 @@ class VectorStore():
                         FieldCondition(key="id", match=MatchValue(value=filter_item.id))
                     ]
                 ))
-        
-        response = self.__client.search(
+        return Filter(should=filter_conditions)
+
+
+    def get_relevant_items(self, query: ItemReference, query_filter: Filter, limit: int = RELEVANT_ITEMS_LIMIT) -> List[ItemReference]:
+        [relevant_items] = self.get_relevant_items_batch([query], query_filter, limit)
+        return relevant_items
+
+
+    def fetch_embeddings(self, queries: List[ItemReference]) -> List[list[float]]:
+        # One scroll for every query's embedding, instead of one request per query
+        records = self.get_records(queries, True)
+        embeddings = []
+        for query in queries:
+            record = records.get(query)
+            if not record:
+                raise Exception(f"No embedding record found for item ({query.provider} {query.id})")
+            if not record.vector:
+                raise Exception(f"No vector found in embedding record for item ({query.provider} {query.id})")
+            embeddings.append(record.vector)
+        return embeddings
+
+
+    def get_relevant_items_batch(self, queries: List[ItemReference], query_filter: Filter, limit: int = RELEVANT_ITEMS_LIMIT) -> List[List[ItemReference]]:
+        return self.get_relevant_items_by_embedding(self.fetch_embeddings(queries), query_filter, limit)
+
+
+    def get_relevant_items_by_embedding(self, embeddings: List[list[float]], query_filter: Filter, limit: int = RELEVANT_ITEMS_LIMIT) -> List[List[ItemReference]]:
+        # One batched search, instead of one request per query
+        responses = self.__client.query_batch_points(
             collection_name=QDRANT_COLLECTION_NAME,
-            query_vector=embedding,
-            limit=limit,
-            query_filter=Filter(should=filter_conditions)
+            requests=[
+                QueryRequest(
+                    query=embedding,
+                    filter=query_filter,
+                    limit=limit,
+                    params=SearchParams(hnsw_ef=RELEVANT_ITEMS_HNSW_EF),
+                    with_payload=ITEM_REF_PAYLOAD_FIELDS,
+                    with_vector=False
+                )
+                for embedding in embeddings
+            ]
         )
 
         return [
-            payload_to_item_ref(record.payload)
-            for record in response
+            [payload_to_item_ref(point.payload) for point in response.points]
+            for response in responses
         ]
 
 
@@ -148,18 +217,14 @@ def payload_to_item_ref(payload: Optional[Dict]) -> ItemReference:
     if not payload:
         raise Exception("Missing payload")
     
-    if not payload.get('provider'):
-        raise Exception("Missing `provider` in payload")
-    
-    if not payload.get('sheet_name'):
-        raise Exception("Missing `sheet_name` in payload")
-    
-    if not payload.get('id'):
-        raise Exception("Missing `id` in payload")
+    provider = PROVIDER_BY_VALUE.get(payload.get('provider'))
+    sheet_name = SHEET_NAME_BY_VALUE.get(payload.get('sheet_name'))
+    id = payload.get('id')
+    if provider is None or sheet_name is None or not id:
+        raise Exception(f"Invalid `provider`, `sheet_name` or `id` in payload: {payload}")
     
     return ItemReference(
-        provider=Provider(payload['provider']),
-        sheet_name=SheetName(payload['sheet_name']),
-        id=payload['id']
+        provider=provider,
+        sheet_name=sheet_name,
+        id=id
     )
-